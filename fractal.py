@@ -2,8 +2,18 @@
 # Derived from source at https://matplotlib.org/examples/showcase/mandelbrot.html
 from math import log
 from abc import ABC, abstractmethod
-from multiprocessing.managers import SharedMemoryManager
-import struct
+from multiprocessing.shared_memory import SharedMemory
+from functools import partial
+
+import numpy as np
+
+try:
+    import numba
+    from numba import cuda
+    from llvmlite.binding import get_host_cpu_features
+except ImportError: # Without Numba we fall back to the vectorized NumPy kernel
+    numba = None
+    cuda = None
 
 class Fractal(ABC):
     """The abstract Fractal class defines a standard interface for multiprocessing and display."""
@@ -22,18 +32,18 @@ class Fractal(ABC):
         pass
 
     @abstractmethod
-    def generate_tasks(self, smm: SharedMemoryManager, num_tasks: int):
+    def generate_tasks(self, num_tasks: int):
         """
         This method generates the tasks necessary to process the fractal image.
-        It uses the shared memory manager to allocate shared memory blocks that can be accessed 
-        across processes (for multiprocessing). It returns a list of tasks (lambdas) and a list of 
-        shared memory blocks allocated by the object as (tasks, data).
+        It allocates shared memory blocks that can be accessed across processes (for multiprocessing). 
+        It returns a list of picklable tasks, the array views over the shared memory blocks, the blocks 
+        themselves and a description of the calculation as (tasks, data, blocks, run). The caller 
+        closes and unlinks the blocks once it is done with the views.
 
         Parameters:
-        `smm`: A SyncManager object for managing shared memory.
         `num_tasks`: Number of tasks to process the image.
         """
-        return None, None
+        return None, None, None, None
 
     # Properties for common traits among fractals
     @property
@@ -69,88 +79,353 @@ class Fractal(ABC):
         self._iterations = new_iterations
 
 
+# True where c lies inside the main cardioid or the period-2 bulb, which never escape. Only uses
+# arithmetic and `|`, so it works on scalars inside the compiled kernels as well as on NumPy arrays.
+def _in_main_bulbs(cr, ci):
+    shifted = cr - 0.25
+    p = shifted * shifted + ci * ci
+    return (p * (p + shifted) <= 0.25 * ci * ci) | ((cr + 1.0) * (cr + 1.0) + ci * ci <= 0.0625)
+
+
+# Vectorized escape-time kernel for a band of rows; each step updates every pixel that has not escaped yet.
+# Iteration resumes at start_iteration from the z and n already in the planes, and N keeps the raw
+# count of the last iteration each pixel was inside for so a later call can carry on from it.
+def _row_vectorized(horizon, start_iteration, iterations, row_start, row_end, ZR, ZI, N, CR, CI, Q, width):
+    horizon2 = float(horizon) * float(horizon)
+    log_horizon = log(log(float(horizon))) / log(2)
+    cr = CR[row_start:row_end]
+    ci = CI[row_start:row_end]
+    zr = ZR[row_start:row_end].copy()
+    zi = ZI[row_start:row_end].copy()
+    n = N[row_start:row_end].copy()
+    skip = _in_main_bulbs(cr, ci)
+    # In single precision an escaped pixel's squared magnitude can overflow to inf, which still compares as escaped
+    with np.errstate(over='ignore'):
+        for k in range(start_iteration, iterations):
+            zr2 = zr * zr
+            zi2 = zi * zi
+            active = ((zr2 + zi2) < horizon2) & ~skip
+            zi[active] = 2.0 * zr[active] * zi[active] + ci[active]
+            zr[active] = zr2[active] - zi2[active] + cr[active]
+            n[active] = k
+    n[skip] = iterations - 1
+    count = np.where(n == iterations - 1, 0, n)
+
+    # log(|z|) = log(|z|^2) / 2 saves the sqrt. log(log(|z|)) is undefined for |z| <= 1, so those pixels
+    # come out as nan or inf and are smoothed to zero in a single masked pass.
+    abs2 = zr.astype(np.float64) ** 2 + zi.astype(np.float64) ** 2
+    with np.errstate(all='ignore'):
+        q = count + 1.0 - np.log(0.5 * np.log(abs2)) / log(2) + log_horizon
+    ZR[row_start:row_end] = zr
+    ZI[row_start:row_end] = zi
+    N[row_start:row_end] = n
+    Q[row_start:row_end] = np.where(np.isfinite(q) & ~skip, q, 0.0)
+
+
+# Returns the width in bytes of the widest vector register on this CPU (64 for AVX-512, 32 for AVX2,
+# 16 for SSE2), which decides how many neighbouring pixels are iterated together. 8 bytes means a
+# scalar loop over doubles.
+def _host_vector_bytes():
+    try:
+        features = get_host_cpu_features()
+    except RuntimeError:
+        return 8
+    for feature, size in (('avx512f', 64), ('avx2', 32), ('sse2', 16)):
+        if features.get(feature):
+            return size
+    return 8
+
+# Escape-time kernel for a band of rows; compiled once by Numba and cached on disk between runs.
+# Pixels are processed in blocks that fill one vector register (twice as many in single precision)
+# with branch-free updates, and a block only stops once every lane in it has escaped.
+# The iteration count stays a runtime argument: the loop exits early once a block escapes, so baking it
+# in as a constant (or unrolling the loop) gains nothing and would recompile for every new count.
+if numba is not None:
+    _VECTOR_BYTES = _host_vector_bytes()
+    _in_main_bulbs_cpu = numba.njit(inline='always')(_in_main_bulbs)
+    _in_main_bulbs_gpu = cuda.jit(device=True)(_in_main_bulbs)
+
+    # Fast math without 'ninf' and 'nnan': escaped single precision lanes overflow to inf, and the
+    # escape test relies on inf still comparing as outside the horizon.
+    @numba.njit(parallel=True, fastmath={'contract', 'arcp', 'nsz', 'afn', 'reassoc'}, cache=True)
+    def _row_kernel(horizon, start_iteration, iterations, row_start, row_end, ZR, ZI, N, CR, CI, Q, width):
+        # Keep every constant in the planes' precision so single precision math is not promoted to double
+        real = CR.dtype.type
+        vector = _VECTOR_BYTES // CR.itemsize
+        horizon2 = real(float(horizon) * float(horizon))
+        two = real(2.0)
+        log_horizon = log(log(float(horizon))) / log(2)
+        for row in numba.prange(row_start, row_end):
+            cr = np.zeros(vector, CR.dtype)
+            ci = np.zeros(vector, CR.dtype)
+            zr = np.zeros(vector, CR.dtype)
+            zi = np.zeros(vector, CR.dtype)
+            n = np.zeros(vector, CR.dtype)
+            skip = np.zeros(vector, np.bool_)
+            for block in range(0, width, vector):
+                lanes = min(vector, width - block)
+
+                # A short final block is padded with copies of its last pixel, which are never written back
+                for lane in range(vector):
+                    col = block + min(lane, lanes - 1)
+                    cr[lane] = CR[row, col]
+                    ci[lane] = CI[row, col]
+                    zr[lane] = ZR[row, col]
+                    zi[lane] = ZI[row, col]
+                    n[lane] = N[row, col]
+                    skip[lane] = _in_main_bulbs_cpu(cr[lane], ci[lane])
+
+                for k in range(start_iteration, iterations):
+                    # Compare squared magnitudes so we never need the sqrt
+                    any_inside = False
+                    for lane in range(vector):
+                        zr2 = zr[lane] * zr[lane]
+                        zi2 = zi[lane] * zi[lane]
+                        inside = (zr2 + zi2 < horizon2) & ~skip[lane]
+                        zi[lane] = two * zr[lane] * zi[lane] + ci[lane] if inside else zi[lane]
+                        zr[lane] = zr2 - zi2 + cr[lane] if inside else zr[lane]
+                        n[lane] = k if inside else n[lane]
+                        any_inside |= inside
+                    if not any_inside:
+                        break
+
+                for lane in range(lanes):
+                    col = block + lane
+                    if skip[lane]: n[lane] = iterations - 1
+                    count = n[lane]
+                    if count == iterations - 1: count = 0
+
+                    ZR[row, col] = zr[lane]
+                    ZI[row, col] = zi[lane]
+                    N[row, col] = n[lane]
+
+                    # log(log(|z|)) is only defined for |z| > 1; everything else is smoothed to zero.
+                    # |z|^2 is taken in double precision since an escaped z squared overflows float32,
+                    # and log(|z|) = log(|z|^2) / 2 saves the sqrt.
+                    abs2 = numba.float64(zr[lane]) ** 2 + numba.float64(zi[lane]) ** 2
+                    if abs2 > 1.0 and not skip[lane]:
+                        Q[row, col] = count + 1 - log(0.5 * log(abs2)) / log(2) + log_horizon
+                    else:
+                        Q[row, col] = 0.0
+
+    # GPU escape-time kernel with one thread per pixel; x runs along a row so neighbouring threads read neighbouring memory.
+    @cuda.jit
+    def _mandel_gpu(CR, CI, ZR, ZI, N, Q, start_iteration, iterations, horizon2, log_horizon):
+        col, row = cuda.grid(2)
+        if row >= CR.shape[0] or col >= CR.shape[1]:
+            return
+
+        # horizon2 is passed in the planes' precision so the loop never promotes to double
+        cr = CR[row, col]
+        ci = CI[row, col]
+        zr = ZR[row, col]
+        zi = ZI[row, col]
+        n = N[row, col]
+        if _in_main_bulbs_gpu(cr, ci):
+            N[row, col] = iterations - 1
+            Q[row, col] = 0.0
+            return
+
+        for k in range(start_iteration, iterations):
+            zr2 = zr * zr
+            zi2 = zi * zi
+            if zr2 + zi2 >= horizon2:
+                break
+            zi = (zr * zi + zr * zi) + ci
+            zr = zr2 - zi2 + cr
+            n = k
+        ZR[row, col] = zr
+        ZI[row, col] = zi
+        N[row, col] = n
+        if n == iterations - 1: n = 0
+
+        abs2 = numba.float64(zr) ** 2 + numba.float64(zi) ** 2
+        if abs2 > 1.0:
+            Q[row, col] = n + 1 - log(0.5 * log(abs2)) / log(2.0) + log_horizon
+        else:
+            Q[row, col] = 0.0
+else:
+    _row_kernel = _row_vectorized
+
+
+# Calculates a band of rows and marks the task as done when it completes
+def _row_set_calc(task_no, horizon, start_iteration, iterations, row_range, D, ZR, ZI, CR, CI, N, Q):
+    if D[task_no]:
+        raise Exception("Tried to run task which was already completed!")
+
+    _row_kernel(horizon, start_iteration, iterations, row_range.start, row_range.stop, ZR, ZI, N, CR, CI, Q, ZR.shape[1])
+    D[task_no] = 1
+
+
+# Initializes a pool worker process. The pool already runs one process per core, so each worker's kernel
+# keeps to a single Numba thread instead of starting a thread pool the size of the whole machine.
+def init_worker():
+    if numba is not None:
+        numba.set_num_threads(1)
+
+
+# Runs a task in a worker process. Only the blocks' names travel to the worker (so tasks pickle for
+# a process pool); it reattaches to them, and the views must be gone before the blocks are closed.
+def _run_task(task_no, horizon, start_iteration, iterations, row_range, specs):
+    blocks = [SharedMemory(name=name) for name, _, _ in specs]
+    try:
+        views = [np.ndarray(shape, dtype=dtype, buffer=block.buf) for block, (_, shape, dtype) in zip(blocks, specs)]
+        _row_set_calc(task_no, horizon, start_iteration, iterations, row_range, *views)
+        del views
+    finally:
+        for block in blocks:
+            block.close()
+
+
 class Mandelbrot(Fractal):
     """Derives from the Fractal class and its methods are specific to the Mandelbrot set."""
     _X_BOUNDARY = (-2.25, 0.75)
     _Y_BOUNDARY = (-1.25, 1.25)
+    # Below this distance between neighbouring pixels single precision can no longer tell them apart
+    _SINGLE_PRECISION_LIMIT = 1e-6
+    # The rows are split into this many bands per task so that workers which finish early pick up more, but
+    # never into bands thinner than _MIN_BAND_ROWS, where the per-task overhead outweighs the balancing
+    _BANDS_PER_TASK = 4
+    _MIN_BAND_ROWS = 64
 
 
-    # These one-line functions *should* be inlined by python... (skeptical look at interpreter...)
-    def complex_list_to_bytes(self, clist):
-        return b''.join([struct.pack('dd', num.real, num.imag) for num in clist])
-
-
-    def bytes_to_complex_list(self, seq):
-        return [complex(*struct.unpack('dd', seq[index * 16:(index+1)*16])) for index in range(len(seq) // 16)]
+    # Allocates a new shared memory block and wraps it in an array view (no copies, no serialization)
+    def shared_array(self, shape, dtype):
+        block = SharedMemory(create=True, size=max(1, int(np.prod(shape)) * np.dtype(dtype).itemsize))
+        array = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+        array[:] = 0
+        return block, array
 
 
+    # The image is the Q plane itself; Matplotlib takes the shared memory view without any repacking
     def data_to_image_matrix(self, data):
-        return [struct.unpack('d' * self.dimensions[0], row_data[:-1]) for row_data in data[3]]
+        return data[5]
 
 
-    def __init__(self, image_width: int, image_height: int, iterations: int):
+    def __init__(self, image_width: int, image_height: int, iterations: int, precision: str = 'f4'):
         self.x_range = Mandelbrot._X_BOUNDARY
         self.y_range = Mandelbrot._Y_BOUNDARY
         self.dimensions = (image_width, image_height)
         self.iterations = iterations
         self.horizon = 0x1000000000
+        self.precision = precision
+        self.use_gpu = cuda is not None and cuda.is_available()
+        self._device = None
+
+        # z and n from the last finished calculation, so raising the iteration count only runs the extra iterations
+        self._iter_done = 0
+        self._state = None
 
+        # Coordinate planes for the geometry in _grid_key, reused by every calculation until the geometry changes
+        self._grid_key = None
+        self._C_cache = None
 
-    # Wraps a task call so that we can mark it as done when it completes
-    def run_task(self, task_no, done_array, function, parameters):
-        if done_array[task_no]:
-            raise Exception("Tried to run task which was already completed!")
-
-        value = function(*parameters)
-        done_array[task_no] = 1
-        return value
-
-
-    # Calculates information for a particular row of coordinates (used for async tasks)
-    def row_set_calc(self, horizon, iterations, row_range, Z, N, C, Q):
-        log_horizon = log(log(horizon)) / log(2)
-        for row in row_range:
-            c = self.bytes_to_complex_list(C[row][:-1])
-            z = self.bytes_to_complex_list(Z[row][:-1])
-            q = list(struct.unpack('d' * self.dimensions[0], Q[row][:-1]))
-            n = list(struct.unpack('d' * self.dimensions[0], N[row][:-1]))
-
-            for col in range(len(c)):
-                for round in range(iterations):
-                    if abs(z[col]) < horizon:
-                        z[col] = z[col] ** 2 + c[col]
-                        n[col] = round
-                if n[col] == iterations - 1: n[col] = 0
-
-                # This is ugly as sin, but it is the fastest way to do this.
-                try:
-                    q[col] = n[col] + 1 - log(log(abs(z[col])))/log(2) + log_horizon
-                except:
-                    q[col] = 0.0
-
-            C[row] = self.complex_list_to_bytes(c) + b'\n'
-            N[row] = struct.pack('d' * self.dimensions[0], *n) + b'\n'
-            Z[row] = self.complex_list_to_bytes(z) + b'\n'
-            Q[row] = struct.pack('d' * self.dimensions[0], *q) + b'\n'
-
-
-    # Generates tasks to generate the Mandelbrot Set data and returns the receptical image matrix
-    def generate_tasks(self, smm: SharedMemoryManager, num_tasks: int):
-        dx = (self.x_range[1] - self.x_range[0]) / (self.dimensions[0] - 1) if self.dimensions[0] > 1 else 0
-        dy = (self.y_range[1] - self.y_range[0]) / (self.dimensions[1] - 1) if self.dimensions[1] > 1 else 0
-        task_rows = self.dimensions[1] / num_tasks
-
-        X = [self.x_range[0] + dx * index for index in range(self.dimensions[0])]
-        Y = [self.y_range[0] + dy * index for index in range(self.dimensions[1])]
-
-        # So the ShareableList type is broken and truncates zeroes (ugh)... so we add '\n' to the end to prevent this.
-        C = smm.ShareableList([self.complex_list_to_bytes([complex(real, imag) for real in X]) + b'\n' for imag in Y])
-        N = smm.ShareableList([struct.pack('d', 0) * self.dimensions[0] + b'\n' for _ in range(self.dimensions[1])])
-        Z = smm.ShareableList([struct.pack('d', 0) * self.dimensions[0] * 2 + b'\n' for _ in range(self.dimensions[1])])
-        Q = smm.ShareableList([struct.pack('d', 0) * self.dimensions[0] + b'\n' for _ in range(self.dimensions[1])])
-        D = smm.ShareableList([0 for _ in range(num_tasks)])
-
-        ranges = [range(round(task_no * task_rows), round((task_no + 1) * task_rows)) for task_no in range(num_tasks)]
-        lambda_generator = (lambda rows, id: (lambda: self.run_task(id, D, self.row_set_calc, (self.horizon, self.iterations, rows, Z, N, C, Q))))
-        tasks = [lambda_generator(row_range, id) for id, row_range in enumerate(ranges)]
-        return tasks, (C, N, Z, Q, D)
+
+    # Working precision of the planes: the requested precision, promoted to float64 once x_range and y_range are
+    # narrowed too far for float32. The GUI's zoom and pan only move the axes over the image and leave them unchanged.
+    @property
+    def dtype(self):
+        return self.grid_key()[3]
+
+
+    # Identifies everything the pixel coordinates depend on; cached planes and state are only valid for one key.
+    # Each attribute is read once, so the key is a consistent snapshot even while the GUI thread changes them.
+    def grid_key(self):
+        dimensions, x_range, y_range = self.dimensions, self.x_range, self.y_range
+        width, height = dimensions
+        pixel_size = min(abs(x_range[1] - x_range[0]) / width, abs(y_range[1] - y_range[0]) / height)
+        if self.precision == 'f4' and pixel_size >= Mandelbrot._SINGLE_PRECISION_LIMIT:
+            return (dimensions, x_range, y_range, np.float32)
+        return (dimensions, x_range, y_range, np.float64)
+
+
+    # Returns the real (X) and imaginary (Y) coordinates of the pixel columns and rows for a grid key
+    def grid_axes(self, key):
+        (width, height), x_range, y_range, dtype = key
+        dx = (x_range[1] - x_range[0]) / (width - 1) if width > 1 else 0
+        dy = (y_range[1] - y_range[0]) / (height - 1) if height > 1 else 0
+        return (x_range[0] + dx * np.arange(width)).astype(dtype), (y_range[0] + dy * np.arange(height)).astype(dtype)
+
+
+    # Returns the contiguous cr and ci planes for a grid key, which are only rebuilt when the key changes
+    def grid_planes(self, key):
+        if key != self._grid_key:
+            (width, height), _, _, _ = key
+            X, Y = self.grid_axes(key)
+            self._C_cache = (np.ascontiguousarray(np.broadcast_to(X[None, :], (height, width))),
+                             np.ascontiguousarray(np.broadcast_to(Y[:, None], (height, width))))
+            self._grid_key = key
+        return self._C_cache
+
+
+    # Calculates the whole image on the GPU and returns it; the device planes are kept until the geometry changes
+    def render_gpu(self):
+        # Work from one snapshot of the parameters, which the GUI thread may change at any time
+        key = self.grid_key()
+        iterations = self.iterations
+        (width, height), _, _, dtype = key
+        if self._device is None or self._device[0] != key:
+            CR, CI = [cuda.to_device(plane) for plane in self.grid_planes(key)]
+            Q = cuda.device_array((height, width), dtype=dtype)
+            image = cuda.pinned_array((height, width), dtype=dtype)
+            self._device = (key, CR, CI, Q, image)
+            self._state = None
+
+        # Start over from z = 0 unless the iteration count only went up since the last calculation
+        if self._state is None or iterations < self._iter_done:
+            ZR = cuda.to_device(np.zeros((height, width), dtype=dtype))
+            ZI = cuda.to_device(np.zeros((height, width), dtype=dtype))
+            N = cuda.to_device(np.zeros((height, width), dtype=np.int32))
+            self._state = (key, ZR, ZI, N)
+            self._iter_done = 0
+
+        _, CR, CI, Q, image = self._device
+        _, ZR, ZI, N = self._state
+        horizon2 = dtype(float(self.horizon) * float(self.horizon))
+        log_horizon = log(log(float(self.horizon))) / log(2)
+        blocks = ((width + 15) // 16, (height + 15) // 16)
+        _mandel_gpu[blocks, (16, 16)](CR, CI, ZR, ZI, N, Q, self._iter_done, iterations, horizon2, log_horizon)
+        self._iter_done = iterations
+        # Copy into the page-locked plane for a fast transfer, then hand out a copy of it, since the next
+        # calculation refills the plane while the display may still be holding this image
+        return Q.copy_to_host(image).copy()
+
+
+    # Generates tasks to generate the Mandelbrot Set data and returns the receptical image matrix.
+    # Each task is a band of whole rows; the pool hands the bands out as workers free up.
+    def generate_tasks(self, num_tasks: int):
+        # Work from one snapshot of the parameters, which the GUI thread may change at any time
+        key = self.grid_key()
+        iterations = self.iterations
+        (width, height), _, _, dtype = key
+        bands = min(num_tasks * Mandelbrot._BANDS_PER_TASK, max(num_tasks, height // Mandelbrot._MIN_BAND_ROWS))
+        band_rows = height / bands
+        ranges = [range(round(band * band_rows), round((band + 1) * band_rows)) for band in range(bands)]
+
+        # Each plane is a separate contiguous array (structure of arrays) so the kernels stream through them.
+        blocks, planes = zip(*[self.shared_array((height, width), dtype) for _ in range(6)])
+        ZR, ZI, CR, CI, N, Q = planes
+        D_block, D = self.shared_array((len(ranges),), np.uint8)
+        CR[:], CI[:] = self.grid_planes(key)
+        blocks = (D_block,) + blocks
+
+        # If only the iteration count went up since the last calculation, carry on from where it stopped.
+        start_iteration = 0
+        if self._state is not None and self._state[0] == key and iterations >= self._iter_done:
+            ZR[:], ZI[:], N[:] = self._state[1:]
+            start_iteration = self._iter_done
+        run = (key, iterations, start_iteration)
+
+        specs = [(block.name, array.shape, array.dtype.str) for block, array in zip(blocks, (D,) + planes)]
+        tasks = [partial(_run_task, id, self.horizon, start_iteration, iterations, row_range, specs) for id, row_range in enumerate(ranges)]
+        # The views borrow the blocks' buffers, so the blocks have to outlive them.
+        return tasks, (ZR, ZI, CR, CI, N, Q, D), blocks, run
+
+
+    # Keeps z and n once all tasks from generate_tasks have finished, so the next calculation can resume from them.
+    # run is the description generate_tasks returned with data, so the planes are always saved under their own key.
+    def save_state(self, data, run):
+        key, iterations, _ = run
+        ZR, ZI, _, _, N, _, _ = data
+        self._state = (key, ZR.copy(), ZI.copy(), N.copy())
+        self._iter_done = iterations
@@ -1,5 +1,5 @@
 from PySide2.QtUiTools import QUiLoader
-from PySide2.QtCore import QFile, QIODevice, QObject, Qt, QEvent
+from PySide2.QtCore import QFile, QIODevice, QObject, Qt, QEvent, QTimer, Signal
 from PySide2.QtGui import QIntValidator
 from PySide2.QtWidgets import QWidget, QVBoxLayout, QLineEdit, QPushButton, QLabel
 
@@ -8,12 +8,14 @@ from matplotlib.axes import Axes
 from matplotlib.figure import Figure
 from matplotlib.backends.backend_qtagg import FigureCanvasQTAgg as FigureCanvas
 
+import numpy as np
+
 import sys
-from multiprocessing import Process
-from multiprocessing.managers import SharedMemoryManager
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
 import threading
 
-from fractal import Mandelbrot
+from fractal import Mandelbrot, init_worker
 
 
 class FractalApp(QObject):
@@ -21,6 +23,9 @@ class FractalApp(QObject):
     Responsible for storing and updating the fractal set and its image representation.
     """
 
+    # Carries a finished image from the calculation thread to the GUI thread, which owns the widgets
+    image_ready = Signal(object)
+
     def __init__(self, file: str):
         """
         Creates a FractalWindow widget from a .UI file and instantiates the Mandelbrot set 
@@ -39,7 +44,26 @@ class FractalApp(QObject):
         self._def_resolution_x = self._root_widget.resolution_x.text()
         self._def_resolution_y = self._root_widget.resolution_y.text()
 
+        # Bursts of edits are collapsed into a single update once the input settles
+        self._redraw_timer = QTimer(self)
+        self._redraw_timer.setSingleShot(True)
+        self._redraw_timer.timeout.connect(self.update_plot)
+
+        # Calculations run one at a time, and one still waiting when a newer update is requested is dropped
+        self._calc_lock = threading.Lock()
+        self._calc_request = 0
+
+        # Worker processes are started once and reused for every update
+        self._pool = None
+        self._pool_workers = 0
+        self.get_pool(int(self._def_processes))
+
+        # The image is animated so full draws leave it out; it is drawn over a saved background instead
         self._image = None
+        self._background = None
+        self._root_widget.canvas.mpl_connect('draw_event', self.on_draw)
+        self.image_ready.connect(self.show_image)
+
         self._fractal = Mandelbrot(
             int(self._def_resolution_x),
             int(self._def_resolution_y),
@@ -54,49 +78,124 @@ class FractalApp(QObject):
         prevent the application from locking up.
         """
         self._root_widget.status.setText("Calculating set...")
+        self._calc_request += 1
+        request = self._calc_request
+        num_tasks = int(self._root_widget.processes.text())
 
         # Create and start a non-GUI thread for image processing so that the GUI does not freeze
         def process_image():
-            num_tasks = int(self._root_widget.processes.text())
-            with SharedMemoryManager() as smm:
-                tasks, data = self._fractal.generate_tasks(smm, num_tasks)
-
-            # Create and start appropriate number of processes to execute tasks.
-            processes = [Process(target=task) for task in tasks]
-            for p in processes:
-                p.start()
-            for p in processes:
-                p.join()
-
-            # Get updated image data and update the AxesImage object.
-            image_matrix = self._fractal.data_to_image_matrix(data)
-            if self._image is None:
-                self._image = self._root_widget.axes.imshow(image_matrix)
-                self._root_widget.status.setText("")
-                self._root_widget.canvas.draw()
-                self._def_xlim = self._root_widget.canvas.figure.gca().get_xlim()
-                self._def_ylim = self._root_widget.canvas.figure.gca().get_ylim()
+            with self._calc_lock:
+                if request == self._calc_request:
+                    calculate()
+
+        def calculate():
+            if self._fractal.use_gpu:
+                image_matrix = self._fractal.render_gpu()
             else:
-                self._image.set_data(image_matrix)
-                self._root_widget.status.setText("")
-                self._root_widget.canvas.draw()
+                pool = self.get_pool(num_tasks)
+                tasks, data, blocks, run = self._fractal.generate_tasks(num_tasks)
+                try:
+                    # Hand the tasks to the worker processes and wait for all of them to finish.
+                    futures = [pool.submit(task) for task in tasks]
+                    for future in futures:
+                        future.result()
+                    self._fractal.save_state(data, run)
+                    image_matrix = np.array(self._fractal.data_to_image_matrix(data), copy=True)
+                finally:
+                    # Release the shared memory once the image is copied out; the views over the
+                    # blocks have to be gone before the blocks can be closed.
+                    del data
+                    for block in blocks:
+                        block.close()
+                        block.unlink()
+
+            # Widgets may only be touched from the GUI thread, so the image is handed over to show_image
+            self.image_ready.emit(image_matrix)
 
         threading.Thread(target=process_image, daemon=True).start()
 
+    def show_image(self, image_matrix):
+        """
+        Updates the AxesImage object with a newly calculated image. Runs on the GUI thread, as it is
+        connected to the image_ready signal emitted by the calculation thread.
+
+        Parameters:
+        `image_matrix`: The calculated image.
+        """
+        if self._image is None:
+            self._image = self._root_widget.axes.imshow(image_matrix, interpolation='nearest', animated=True)
+            self._root_widget.status.setText("")
+            self._root_widget.canvas.draw()
+            self._def_xlim = self._root_widget.canvas.figure.gca().get_xlim()
+            self._def_ylim = self._root_widget.canvas.figure.gca().get_ylim()
+        else:
+            # Only the image changed, so repaint it over the saved background and blit the axes
+            canvas, axes = self._root_widget.canvas, self._root_widget.axes
+            self._image.set_data(image_matrix)
+            self._root_widget.status.setText("")
+            canvas.restore_region(self._background)
+            axes.draw_artist(self._image)
+            canvas.blit(axes.bbox)
+
+    def on_draw(self, event):
+        """
+        Saves the freshly drawn axes without the image as the background for later updates, then
+        draws the image on top, since full draws skip animated artists.
+
+        Parameters:
+        `event`: The Matplotlib draw event.
+        """
+        if self._image is None:
+            return
+        self._background = self._root_widget.canvas.copy_from_bbox(self._root_widget.axes.bbox)
+        self._root_widget.axes.draw_artist(self._image)
+
+    def get_pool(self, workers: int) -> ProcessPoolExecutor:
+        """
+        Returns the worker process pool, replacing it first if the number of processes has changed.
+        Workers are spawned rather than forked so they never inherit the GUI's threads, and each one
+        calculates on a single thread so the number of processes is the only level of parallelism.
+
+        Parameters:
+        `workers`: The number of worker processes.
+        """
+        if self._pool is None or self._pool_workers != workers:
+            if self._pool is not None:
+                self._pool.shutdown(wait=False)
+            self._pool = ProcessPoolExecutor(max_workers=workers, mp_context=get_context('spawn'), initializer=init_worker)
+            self._pool_workers = workers
+        return self._pool
+
+    def shutdown(self):
+        """Stop the worker processes."""
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    def schedule_plot(self, delay: int = 80):
+        """
+        Requests a plot update after `delay` milliseconds without further requests, so that a burst
+        of changes starts one calculation instead of one per change.
+
+        Parameters:
+        `delay`: The idle time in milliseconds to wait before updating.
+        """
+        self._redraw_timer.start(delay)
+
     def update_iterations(self):
         """Update the plot with the changed iterations count."""
         self._fractal.iterations = int(self._root_widget.iterations.text())
-        self.update_plot()
+        self.schedule_plot()
 
     def update_resolution_x(self):
         """Update the plot with the changed resolution x."""
         self._fractal.dimensions = (int(self._root_widget.resolution_x.text()), self._fractal.dimensions[1])
-        self.update_plot()
+        self.schedule_plot()
 
     def update_resolution_y(self):
         """Update the plot with the changed resolution y."""
         self._fractal.dimensions = (self._fractal.dimensions[0], int(self._root_widget.resolution_y.text()))
-        self.update_plot()
+        self.schedule_plot()
 
     def reset(self):
         """Reset visuals and parameters to default values then update plot."""
@@ -112,7 +211,7 @@ class FractalApp(QObject):
         self._root_widget.canvas.figure.gca().set_ylim(self._def_ylim)
         self._root_widget.canvas.draw()
 
-        self.update_plot()
+        self.schedule_plot()
 
     # --------------------------------- Accessors -------------------------------- #
 
@@ -145,6 +244,7 @@ class FractalWindow(QWidget):
         `app`: A reference to the FractalApp instance which called the constructor
         """
         super().__init__()
+        self._app = app
 
         # Load the UI file with self as the parent of the root widget
         ui_file = QFile(file)
@@ -166,7 +266,7 @@ class FractalWindow(QWidget):
         self.iterations.setValidator(QIntValidator(1, 99,  self.iterations))
 
         self.processes = self.get_child(self, QLineEdit, "processes")
-        self.processes.returnPressed.connect(app.update_plot)
+        self.processes.returnPressed.connect(app.schedule_plot)
         self.processes.setValidator(QIntValidator(1, 99,  self.processes))
 
         self.resolution_x = self.get_child(self, QLineEdit, "resolution_x")
@@ -193,6 +293,11 @@ class FractalWindow(QWidget):
         self.eventfilter = EventFilter(self.canvas)
         self.canvas.installEventFilter(self.eventfilter)
 
+    def closeEvent(self, event):
+        """Stop the application's worker processes when the window is closed."""
+        self._app.shutdown()
+        super().closeEvent(event)
+
     def get_child(self, parent, widget_type, widget_name):
         """Helper function for retrieving child widgets"""
         widget = parent.findChild(widget_type, widget_name)
@@ -264,7 +369,8 @@ class EventFilter(QObject):
         self.canvas.figure.gca().set_xlim(new_xlim)
         self.canvas.figure.gca().set_ylim(new_ylim)
         
-        self.canvas.draw()
+        # Only schedule a repaint; Qt coalesces the ones requested while the mouse is still moving
+        self.canvas.draw_idle()
 
     def pan(self, delta):
         """Pan the plot."""
@@ -284,4 +390,4 @@ class EventFilter(QObject):
         self.canvas.figure.gca().set_xlim(new_xlim)
         self.canvas.figure.gca().set_ylim(new_ylim)
 
-        self.canvas.draw()
+        self.canvas.draw_idle()